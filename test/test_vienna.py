@@ -2,7 +2,45 @@
 Tests for `vienna` vienna.py module.
 """
 
-from vienna import fold, folded_structure, cofold, inverse_fold
+import re
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+import vienna.vienna
+from vienna import (
+    fold,
+    fold_many,
+    folded_structure,
+    cofold,
+    inverse_fold,
+    inverse_fold_many,
+    clear_cache,
+    RNAfoldWorker,
+    does_sequence_fold_to,
+)
+
+
+@pytest.fixture
+def no_rna_lib(monkeypatch):
+    """
+    Run a test with the Vienna programs instead of the RNA python module
+    """
+    monkeypatch.setattr(vienna.vienna, "RNA", None)
+    clear_cache()
+    yield
+    clear_cache()
+
+
+@pytest.fixture
+def shared_inverse_worker():
+    """
+    Stop the shared RNAinverse process after a test, even if it fails
+    """
+    yield
+    vienna.vienna._close_inverse_worker()
 
 
 def test_fold():
@@ -29,6 +67,210 @@ def test_fold_bp_prob():
     assert len(r.bp_probs) == 14
 
 
+def test_fold_auto_algorithm(monkeypatch):
+    """
+    Test that algorithm="auto" only uses LinearFold without the ensemble,
+    and that folded_structure always uses ViennaRNA
+    """
+    linear_seqs = []
+
+    def fake_linear_fold(seq):
+        linear_seqs.append(seq)
+        return vienna.vienna.FoldResults(
+            "." * len(seq), 0.0, 0.0, vienna.vienna._no_bp_probs()
+        )
+
+    monkeypatch.setattr(vienna.vienna.globs, "linear_fold_exists", True)
+    monkeypatch.setattr(vienna.vienna, "_fold_with_linear_fold", fake_linear_fold)
+    seq = "GGGGAAAACCCCAUAU" * 40
+    clear_cache()
+    assert fold(seq).ens_defect > 0.0
+    assert linear_seqs == []
+    assert folded_structure(seq) != "." * len(seq)
+    assert does_sequence_fold_to(seq, folded_structure(seq))
+    assert linear_seqs == []
+    fold(seq, compute_ensemble=False)
+    assert linear_seqs == [seq]
+    clear_cache()
+
+
+def test_fold_pair_probabilities():
+    """
+    Test the probability of each nucleotide being paired
+    """
+    r = fold("GGGGAAAACCCC", bp_probs=True)
+    probs = r.pair_probabilities()
+    assert len(probs) == 12
+    assert probs[0] > 0.9
+    assert probs[5] < 0.1
+    assert (r.bp_probs["p"] > 0).all()
+    no_probs = fold("GGGGAAAACCCC").pair_probabilities()
+    assert no_probs.dtype == np.float64
+    assert not no_probs.any()
+
+
+def test_fold_pair_probabilities_at_most_one():
+    """
+    Test that rounding the pair probabilities to float16 does not push the
+    probability of a nucleotide being paired over 1
+    """
+    r = fold("GGGGGGGGGGAAAACCCCCCCCCC" * 3, bp_probs=True)
+    assert (r.pair_probabilities() <= 1.0).all()
+    # without the float64 sums they are rebuilt from the float16 pairs
+    rounded = vienna.vienna.FoldResults(r.dot_bracket, r.mfe, r.ens_defect, r.bp_probs)
+    assert (rounded.pair_probabilities() <= 1.0).all()
+    assert np.allclose(rounded.pair_probabilities(), r.pair_probabilities(), atol=1e-2)
+
+
+def test_fold_bp_probs_cutoff():
+    """
+    Test that the python bindings keep the same pairs RNAfold writes to dot.ps
+    """
+    RNA = pytest.importorskip("RNA")
+    seq = "GGGAAACCCAAAGGGAAACCCAAAUUUGCGCAAAGCGCAUA" * 3
+    r = fold(seq, bp_probs=True)
+    md = RNA.md()
+    md.noLP = 1
+    md.dangles = 2
+    fc = RNA.fold_compound(seq, md)
+    _, energy = fc.mfe()
+    fc.exp_params_rescale(energy)
+    fc.pf()
+    assert len(r.bp_probs) == len(fc.plist_from_probs(1e-5))
+
+
+def test_fold_bp_probs_matrix():
+    """
+    Test the dense base pair probability matrix
+    """
+    r = fold("GGGGAAAACCCC", bp_probs=True)
+    matrix = r.as_matrix()
+    assert matrix.shape == (12, 12)
+    assert matrix.dtype == np.float32
+    assert np.allclose(matrix, matrix.T)
+    assert np.allclose(matrix.sum(axis=1), r.pair_probabilities(), atol=1e-3)
+
+
+def test_fold_cached():
+    """
+    Test that repeated sequences reuse the cached fold results
+    """
+    r = fold("GGGGAAAACCCC")
+    assert fold("ggggaaaacccc") is r
+    clear_cache()
+    assert fold("GGGGAAAACCCC") is not r
+
+
+def test_fold_no_ensemble():
+    """
+    Test skipping the partition function in the fold function
+    """
+    r = fold("GGGGAAAACCCC", compute_ensemble=False)
+    assert r.dot_bracket == "((((....))))"
+    assert r.ens_defect == 0.0
+
+
+def test_fold_many():
+    """
+    Test folding many sequences in parallel
+    """
+    seqs = ["GGGGAAAACCCC", "GGGGAAAACCCC" * 2, "GGGGAAAACCCC" * 3]
+    results = fold_many(seqs, workers=2)
+    assert [r.dot_bracket for r in results] == [fold(s).dot_bracket for s in seqs]
+    assert fold_many(seqs, workers=0) == results
+
+
+@pytest.mark.skipif(shutil.which("RNAfold") is None, reason="needs RNAfold")
+def test_fold_rnafold(no_rna_lib):
+    """
+    Test folding with RNAfold instead of the RNA python module
+    """
+    r = fold("GGGGAAAACCCC", algorithm="vienna")
+    assert r.dot_bracket == "((((....))))"
+    assert r.mfe == pytest.approx(-5.4)
+    assert r.ens_defect > 0.0
+
+
+@pytest.mark.skipif(shutil.which("RNAfold") is None, reason="needs RNAfold")
+def test_fold_bp_probs_dot_ps(no_rna_lib):
+    """
+    Test reading base pair probabilities from the dot.ps written by RNAfold
+    """
+    r = fold("GGGGAAAACCCC", bp_probs=True)
+    assert len(r.bp_probs) > 0
+    assert (r.bp_probs["i"] < r.bp_probs["j"]).all()
+    assert (r.bp_probs["p"] > 0).all() and (r.bp_probs["p"] <= 1).all()
+    assert r.pair_probabilities()[0] > 0.9
+    assert (r.pair_probabilities() <= 1.0).all()
+
+
+@pytest.mark.skipif(shutil.which("RNAfold") is None, reason="needs RNAfold")
+def test_fold_many_rnafold(no_rna_lib):
+    """
+    Test folding many sequences in batches of one RNAfold call each
+    """
+    seqs = ["GGGGAAAACCCC", "GGGAAACCCAAAGGGAAACCC", "GCGCUUCGGCGC" * 3] * 2
+    results = fold_many(seqs, workers=2)
+    assert len(results) == len(seqs)
+    for seq, r in zip(seqs, results):
+        expected = fold(seq)
+        assert r.dot_bracket == expected.dot_bracket
+        assert r.mfe == pytest.approx(expected.mfe)
+        assert r.ens_defect == pytest.approx(expected.ens_defect)
+
+
+@pytest.mark.skipif(shutil.which("RNAfold") is None, reason="needs RNAfold")
+def test_fold_matches_command_line():
+    """
+    Test that fold gives the same results as RNAfold, all sequences are
+    folded in one RNAfold call and parsed with one regex sweep
+    """
+    mfe_re = re.compile(r"^(\S+)\s+\(\s*(-?\d+\.\d+)\)$", re.M)
+    seqs = ["GGGGAAAACCCC", "GGGAAACCCAAAGGGAAACCC", "GCGCUUCGGCGC" * 3]
+    output = subprocess.run(
+        ["RNAfold", "--noLP", "--noPS", "-d2"],
+        input="\n".join(seqs) + "\n",
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    ).stdout
+    matches = list(mfe_re.finditer(output))
+    assert len(matches) == len(seqs)
+    for seq, match in zip(seqs, matches):
+        r = fold(seq, compute_ensemble=False)
+        assert r.dot_bracket == match.group(1)
+        assert r.mfe == pytest.approx(float(match.group(2)))
+
+
+@pytest.mark.skipif(shutil.which("RNAfold") is None, reason="needs RNAfold")
+def test_rnafold_worker():
+    """
+    Test folding several sequences with one persistent RNAfold process
+    """
+    seqs = ["GGGGAAAACCCC", "GGGAAACCCAAAGGGAAACCC"]
+    for compute_ensemble in (True, False):
+        with RNAfoldWorker(compute_ensemble) as worker:
+            for seq in seqs:
+                r = worker.fold(seq)
+                expected = fold(seq, compute_ensemble=compute_ensemble)
+                assert r.dot_bracket == expected.dot_bracket
+                assert r.mfe == pytest.approx(expected.mfe)
+                assert r.ens_defect == pytest.approx(expected.ens_defect)
+
+
+@pytest.mark.skipif(shutil.which("sleep") is None, reason="needs sleep")
+def test_rnafold_worker_timeout(monkeypatch):
+    """
+    Test that the RNAfold worker gives up when RNAfold does not answer
+    """
+    monkeypatch.setattr(vienna.vienna.globs, "rna_fold_exists", True)
+    monkeypatch.setattr(vienna.vienna, "_RNAFOLD_PF_ARGS", ("sleep", "30"))
+    with RNAfoldWorker(timeout=0.2) as worker:
+        with pytest.raises(TimeoutError):
+            worker.fold("GGGGAAAACCCC")
+        assert worker.proc is None
+
+
 def test_folded_structure():
     """
     Test the folded structure function
@@ -37,6 +279,14 @@ def test_folded_structure():
     assert struct == "((((....))))"
 
 
+def test_does_sequence_fold_to():
+    """
+    Test checking if a sequence folds to a target structure
+    """
+    assert does_sequence_fold_to("GGGGAAAACCCC", "((((....))))")
+    assert not does_sequence_fold_to("GGGGAAAACCCC", "............")
+
+
 def test_cofold():
     """
     Test the cofold function
@@ -50,9 +300,126 @@ def test_cofold_longer():
     r = cofold(seq)
 
 
+def test_cofold_pf_length_limit():
+    """
+    Test skipping the partition function for long cofolds
+    """
+    seq = "G" * 20 + "&" + "C" * 20
+    assert cofold(seq).ens_defect > 0.0
+    assert cofold(seq, pf_length_limit=30).ens_defect == 0.0
+
+
+@pytest.mark.skipif(shutil.which("RNAcofold") is None, reason="needs RNAcofold")
+def test_cofold_rnacofold(no_rna_lib):
+    """
+    Test cofolding with RNAcofold, which gives no ensemble diversity
+    """
+    r = cofold("GGGG&AAACCCC")
+    assert r.dot_bracket == "((((&...))))"
+    assert r.mfe < 0.0
+    assert r.ens_defect == 0.0
+
+
 def test_inverse_fold():
     """
     Test the inverse fold function
     """
     r = inverse_fold("(((.(((....))).)))", "NNNgNNNNNNNNNNaNNN", n_sol=5)
     assert len(r) == 5
+
+
+def test_inverse_fold_arrays():
+    """
+    Test the sequence and score arrays of inverse fold results
+    """
+    r = inverse_fold("(((.(((....))).)))", "NNNgNNNNNNNNNNaNNN", n_sol=5)
+    assert r.seqs.shape == (5,)
+    assert r.scores.dtype == np.float32
+    best = r[int(r.scores.argmin())]
+    assert best.score == r.scores.min()
+    assert [s.seq for s in r] == r.seqs.tolist()
+
+
+def test_inverse_fold_many():
+    """
+    Test inverse folding several structures in one call
+    """
+    pairs = [
+        ("(((.(((....))).)))", "NNNgNNNNNNNNNNaNNN"),
+        ("((((....))))", "NNNNNNNNNNNN"),
+    ]
+    results = inverse_fold_many(pairs, n_sol=3)
+    assert len(results) == 2
+    for (secstruct, _), r in zip(pairs, results):
+        assert len(r) == 3
+        assert all(len(s.seq) == len(secstruct) for s in r)
+
+
+@pytest.mark.skipif(shutil.which("RNAinverse") is None, reason="needs RNAinverse")
+def test_inverse_fold_many_rnainverse(no_rna_lib):
+    """
+    Test inverse folding several structures with one RNAinverse process
+    """
+    pairs = [
+        ("(((.(((....))).)))", "NNNgNNNNNNNNNNaNNN"),
+        ("((((....))))", "NNNNNNNNNNNN"),
+        ("((((((....))))))", "gNNNNNNNNNNNNNNc"),
+    ]
+    results = inverse_fold_many(pairs, n_sol=3)
+    assert len(results) == 3
+    for (secstruct, constraint), r in zip(pairs, results):
+        assert len(r) == 3
+        for seq_score in r:
+            assert len(seq_score.seq) == len(secstruct)
+            # lowercase constraints are kept in every solution
+            for nt, c in zip(seq_score.seq, constraint):
+                assert c == "N" or nt.upper() == c.upper()
+
+
+@pytest.mark.skipif(shutil.which("RNAinverse") is None, reason="needs RNAinverse")
+def test_inverse_fold_reuse_process(no_rna_lib, shared_inverse_worker):
+    """
+    Test running several inverse folds through one RNAinverse process
+    """
+    pids = set()
+    for _ in range(2):
+        r = inverse_fold(
+            "(((.(((....))).)))", "NNNgNNNNNNNNNNaNNN", n_sol=5, reuse_process=True
+        )
+        assert len(r) == 5
+        assert all(len(s.seq) == 18 for s in r)
+        pids.add(vienna.vienna._inverse_worker.proc.pid)
+    assert len(pids) == 1
+
+
+@pytest.mark.skipif(shutil.which("cat") is None, reason="needs cat")
+def test_inverse_fold_reuse_process_timeout(
+    no_rna_lib, shared_inverse_worker, monkeypatch
+):
+    """
+    Test that a silent shared RNAinverse process is given up on after the
+    timeout passed to inverse_fold
+    """
+    # cat echoes the input back, which has no solution lines
+    monkeypatch.setattr(vienna.vienna, "_get_inverse_args", lambda n_sol: ["cat"])
+    monkeypatch.setattr(vienna.vienna.globs, "rna_inverse_exists", True)
+    r = inverse_fold(
+        "((((....))))", "NNNNNNNNNNNN", n_sol=5, reuse_process=True, timeout=0.2
+    )
+    assert len(r) == 0
+    assert vienna.vienna._inverse_worker is None
+
+
+@pytest.mark.skipif(shutil.which("cat") is None, reason="needs cat")
+def test_inverse_worker_timeout(monkeypatch):
+    """
+    Test that the RNAinverse worker gives up when no solutions are written
+    """
+    # cat echoes the input back, which has no solution lines
+    monkeypatch.setattr(vienna.vienna, "_get_inverse_args", lambda n_sol: ["cat"])
+    worker = vienna.vienna._InverseWorker(5, timeout=0.2)
+    try:
+        with pytest.raises(TimeoutError):
+            worker.run("((((....))))", "NNNNNNNNNNNN")
+    finally:
+        worker.close()
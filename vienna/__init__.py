@@ -8,8 +8,12 @@ __version__ = "0.7.0"
 
 from .vienna import (
     fold,
+    fold_many,
     folded_structure,
     cofold,
     inverse_fold,
+    inverse_fold_many,
     does_sequence_fold_to,
+    clear_cache,
+    RNAfoldWorker,
 )
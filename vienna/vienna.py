@@ -3,12 +3,34 @@ A simple wrapper for RNAfold. Allows folding of RNA sequences to get
 secondary structure and energy.
 """
 
+import io
 import re
 import os
+import sys
+import atexit
+import queue
+import random
 import subprocess
 import shutil
-from dataclasses import dataclass
-from typing import List, Tuple
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    import RNA
+except ImportError:
+    RNA = None
+
+# instances of slotted dataclasses have no __dict__, the option exists from
+# python 3.10 but frozen slotted dataclasses only pickle from 3.11
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 11) else {}
+# default seconds a long running RNAfold or RNAinverse may go without writing
+_WORKER_TIMEOUT = 300.0
 
 # classes #####################################################################
 
@@ -22,7 +44,7 @@ class Globals:
     rna_fold_exists: bool = False
     rna_cofold_exists: bool = False
     rna_inverse_exists: bool = False
-    version: str = ""
+    linear_fold_exists: bool = False
 
 
 class ViennaException(Exception):
@@ -31,16 +53,79 @@ class ViennaException(Exception):
     """
 
 
-@dataclass(frozen=True, order=True)
+# i, j and probability of a base pair, probabilities are stored as float16
+# (~3 significant digits) to keep dense dot plots small
+BP_PROBS_DTYPE = np.dtype([("i", np.int32), ("j", np.int32), ("p", np.float16)])
+
+
+@dataclass(frozen=True, order=True, **_DATACLASS_SLOTS)
 class FoldResults:
     """
-    Results from calling RNAfold.
+    Results from calling RNAfold. bp_probs is a structured array with the
+    fields i, j and p, see BP_PROBS_DTYPE. paired_probs holds the probability
+    that each nucleotide is paired, summed before p is rounded to float16.
     """
 
     dot_bracket: str
     mfe: float
     ens_defect: float
-    bp_probs: List[List[float]]
+    bp_probs: np.ndarray = field(compare=False)
+    paired_probs: Optional[np.ndarray] = field(default=None, compare=False, repr=False)
+
+    @property
+    def bp_probs_list(self) -> List[List[float]]:
+        """
+        Base pair probabilities as a list of [i, j, probability].
+        """
+        return [list(bp) for bp in self.bp_probs.tolist()]
+
+    def pair_probabilities(self) -> np.ndarray:
+        """
+        Probability that each nucleotide is paired, p(i) = sum_j p(i, j).
+        Requires folding with bp_probs=True, otherwise all are 0.
+
+        Returns:
+            np.ndarray: float64 array with one entry per nucleotide
+        """
+        if self.paired_probs is not None:
+            return self.paired_probs.copy()
+        n_nts = len(self.dot_bracket) - self.dot_bracket.count("&")
+        return _sum_pair_probs(
+            self.bp_probs["i"], self.bp_probs["j"], self.bp_probs["p"], n_nts
+        )
+
+    def as_matrix(self, n: Optional[int] = None) -> np.ndarray:
+        """
+        Base pair probabilities as a dense symmetric matrix, where entry
+        [i - 1, j - 1] is the probability of nucleotides i and j pairing.
+
+        Args:
+            n (Optional[int]): Size of the matrix (default: number of
+                nucleotides)
+
+        Returns:
+            np.ndarray: n x n float32 array
+        """
+        if n is None:
+            n = len(self.dot_bracket) - self.dot_bracket.count("&")
+        matrix = np.zeros((n, n), dtype=np.float32)
+        i_s = self.bp_probs["i"] - 1
+        j_s = self.bp_probs["j"] - 1
+        matrix[i_s, j_s] = self.bp_probs["p"]
+        matrix[j_s, i_s] = self.bp_probs["p"]
+        return matrix
+
+    def decode_bp_probs(self) -> np.ndarray:
+        """
+        Base pair probabilities with the probabilities as float64. This only
+        casts the stored float16 values, it does not recover any precision.
+
+        Returns:
+            np.ndarray: structured array with the fields i, j and p
+        """
+        return self.bp_probs.astype(
+            [("i", np.int32), ("j", np.int32), ("p", np.float64)]
+        )
 
 
 class InverseResults:
@@ -48,7 +133,7 @@ class InverseResults:
     Results from calling RNAinverse.
     """
 
-    @dataclass(frozen=True, order=True)
+    @dataclass(frozen=True, order=True, **_DATACLASS_SLOTS)
     class SeqScore:
         """
         Results from one sequence in the inverse folding.
@@ -57,127 +142,916 @@ class InverseResults:
         seq: str
         score: float
 
+    __slots__ = ("_seqs", "_scores")
+
     def __init__(self, seqs: List[str], scores: List[float]) -> None:
-        self.seq_scores: List[InverseResults.SeqScore] = [
-            self.SeqScore(seq, score) for seq, score in zip(seqs, scores)
-        ]
+        # parallel arrays instead of one SeqScore per solution, SeqScores are
+        # only made when iterating or indexing
+        self._seqs = np.asarray(seqs, dtype=str)
+        self._scores = np.asarray(scores, dtype=np.float32)
+
+    @property
+    def seqs(self) -> np.ndarray:
+        """
+        Generated sequences as an array of strings.
+        """
+        return self._seqs
+
+    @property
+    def scores(self) -> np.ndarray:
+        """
+        Score of each generated sequence as a float32 array.
+        """
+        return self._scores
+
+    @property
+    def seq_scores(self) -> List["InverseResults.SeqScore"]:
+        """
+        Each generated sequence with its score.
+        """
+        return list(self)
 
     def __len__(self) -> int:
-        return len(self.seq_scores)
+        return len(self._seqs)
+
+    def __getitem__(self, index: int) -> "InverseResults.SeqScore":
+        return self.SeqScore(str(self._seqs[index]), float(self._scores[index]))
 
     def __iter__(self):
-        return iter(self.seq_scores)
+        for seq, score in zip(self._seqs.tolist(), self._scores.tolist()):
+            yield self.SeqScore(seq, score)
+
+
+class _PipedProcess:
+    """
+    A long running program in a private directory that is fed through its
+    stdin. A thread queues its output lines, so a reader can give up if the
+    program stops writing.
+    """
+
+    def __init__(self, timeout: float) -> None:
+        self.timeout = timeout
+        self.tmp_dir: Optional[tempfile.TemporaryDirectory] = None
+        self.proc: Optional[subprocess.Popen] = None
+        self.lines: "queue.Queue[bytes]" = queue.Queue()
+        self.reader: Optional[threading.Thread] = None
+
+    def _start(self, args: Tuple[str, ...]) -> None:
+        """
+        Start the program and the thread reading its output.
+
+        Args:
+            args (Tuple[str, ...]): command line of the program
+        """
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.tmp_dir.name,
+        )
+        self.reader = threading.Thread(target=self._read_lines, daemon=True)
+        self.reader.start()
+
+    def _read_lines(self) -> None:
+        """
+        Queue each output line of the program, then b"" once it exits.
+        """
+        for line in self.proc.stdout:
+            self.lines.put(line)
+        self.lines.put(b"")
+
+    def _write(self, text: str) -> None:
+        """
+        Send text to the program.
+
+        Args:
+            text (str): input for the program
+        """
+        self.proc.stdin.write(text.encode())
+        self.proc.stdin.flush()
+
+    def _read_line(self) -> bytes:
+        """
+        Get the next output line of the program.
+
+        Returns:
+            bytes: the line with its newline
+
+        Raises:
+            EOFError: if the program exited
+            TimeoutError: if the program writes nothing for timeout seconds,
+                it is killed since a late line would be read as the next one
+        """
+        try:
+            line = self.lines.get(timeout=self.timeout)
+        except queue.Empty as exc:
+            name = self.proc.args[0]
+            self.close(kill=True)
+            raise TimeoutError(f"{name} stopped writing output") from exc
+        if line == b"":
+            raise EOFError(f"{self.proc.args[0]} exited")
+        return line
+
+    def close(self, kill: bool = False) -> None:
+        """
+        Close the input of the program, wait for it to exit and remove its
+        directory. The program is killed if it does not exit within timeout
+        seconds. Does nothing if the program is not running.
+
+        Args:
+            kill (bool): Kill the program instead of waiting (default: False)
+        """
+        if self.proc is not None:
+            if kill:
+                self.proc.kill()
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                # input left from a write the program did not read
+                pass
+            try:
+                self.proc.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+            self.reader.join()
+            self.proc.stdout.close()
+            self.proc = None
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
+            self.tmp_dir = None
+
+
+class _InverseWorker(_PipedProcess):
+    """
+    A long running RNAinverse process that is fed one structure per job, so
+    repeated inverse folds do not pay for starting RNAinverse each time.
+    """
+
+    def __init__(self, n_sol: int, timeout: float = _WORKER_TIMEOUT) -> None:
+        super().__init__(timeout)
+        self.n_sol = n_sol
+        self._start(_get_inverse_args(n_sol))
+
+    def run(self, secstruct: str, constraint: str) -> Tuple[List[str], List[float]]:
+        """
+        Generate n_sol sequences for one structure and constraint.
+
+        Args:
+            secstruct (str): Secondary structure in dot bracket notation
+            constraint (str): Sequence constraints
+
+        Returns:
+            Tuple[List[str], List[float]]: sequences and their scores
+
+        Raises:
+            TimeoutError: if RNAinverse writes nothing for timeout seconds
+        """
+        self._write(f"{secstruct}\n{constraint}\n")
+        seqs = []
+        scores = []
+        while len(seqs) < self.n_sol:
+            match = _INV_RE.match(self._read_line())
+            if match is None:
+                continue
+            seqs.append(match.group(1).decode("ascii"))
+            scores.append(float(match.group(2)))
+        return seqs, scores
+
+
+class RNAfoldWorker(_PipedProcess):
+    """
+    A long running RNAfold process that folds one sequence per call, so
+    folding many sequences does not pay for starting RNAfold and loading its
+    energy parameters each time. Use it as a context manager:
+
+        with RNAfoldWorker() as worker:
+            results = [worker.fold(seq) for seq in seqs]
+
+    Results are not cached and have no base pair probabilities. fold gives
+    up and stops RNAfold if no output arrives within timeout seconds.
+    """
+
+    def __init__(
+        self, compute_ensemble: bool = True, timeout: float = _WORKER_TIMEOUT
+    ) -> None:
+        super().__init__(timeout)
+        self.compute_ensemble = compute_ensemble
+
+    def __enter__(self) -> "RNAfoldWorker":
+        if not globs.rna_fold_exists:
+            raise ViennaException("RNAfold is not in the path!")
+        self._start(_RNAFOLD_PF_ARGS if self.compute_ensemble else _RNAFOLD_ARGS)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def fold(self, seq: str) -> FoldResults:
+        """
+        Fold an RNA sequence with the running RNAfold process.
+
+        Args:
+            seq (str): The RNA sequence to fold.
+
+        Returns:
+            FoldResults: Results from RNAfold
+
+        Raises:
+            EOFError: if RNAfold exited
+            TimeoutError: if RNAfold writes nothing for timeout seconds, the
+                worker is closed
+        """
+        _validate_seqs([seq])
+        if self.proc is None:
+            raise ViennaException("RNAfoldWorker is not running")
+        self._write(f"{seq.upper()}\n")
+        # the MFE line, or the ensemble diversity line with the partition
+        # function, is the last line RNAfold writes for a sequence
+        last_re = _DIV_RE if self.compute_ensemble else _MFE_RE
+        lines = []
+        while True:
+            line = self._read_line()
+            lines.append(line)
+            if last_re.search(line):
+                break
+        ens_defect, structure, energy = _get_fold_results(b"".join(lines))
+        return FoldResults(structure, energy, ens_defect, _no_bp_probs())
 
 
 # module vars ##################################################################
 
 globs = Globals()
+_MD = None
+# command lines for MFE only, MFE and partition function, and MFE, partition
+# function and dot plot
+_RNAFOLD_ARGS = ("RNAfold", "--noLP", "--noPS", "-d2")
+_RNAFOLD_PF_ARGS = ("RNAfold", "-p", "--noLP", "--noDP", "--noPS", "-d2")
+_RNAFOLD_BP_ARGS = ("RNAfold", "-p", "--noLP", "--noPS", "-d2")
+_RNACOFOLD_ARGS = ("RNAcofold", "--noLP", "--noPS", "-d2")
+# "structure (energy)" and "ensemble diversity x" in RNAfold output
+_MFE_RE = re.compile(rb"^(\S+)[ \t]+\([ \t]*(-?\d+(?:\.\d+)?)\)", re.M)
+_DIV_RE = re.compile(rb"ensemble diversity[ \t]+(-?\d+(?:\.\d+)?)")
+# "i j sqrt(p) ubox" lines of the dot plot
+_UBOX_RE = re.compile(rb"^(\d+)\s+(\d+)\s+(\S+)\s+ubox\s*$", re.M)
+# "sequence distance" solution lines in RNAinverse output
+_INV_RE = re.compile(rb"^(\S+)[ \t]+(-?\d+(?:\.\d+)?)[ \t]*\r?$", re.M)
+# smallest pair probability kept, the default --bppmThreshold RNAfold uses
+# for the pairs it writes to dot.ps
+_BP_PROBS_CUTOFF = 1e-5
+# sequences longer than this use LinearFold with algorithm="auto"
+_LINEAR_FOLD_MIN_LENGTH = 500
+_inverse_worker: Optional[_InverseWorker] = None
+_inverse_lock = threading.Lock()
 
 
 # private functions ############################################################
-def _get_fold_results(lines: List[str]) -> Tuple[float, str, float]:
+def _get_fold_results(output: bytes) -> Tuple[float, str, float]:
     """
-    Get results from RNAfold output.
+    Get results from RNAfold output for one sequence.
 
     Args:
-        lines (List[str]): lines from RNAfold output
+        output (bytes): RNAfold output
 
     Returns:
         Tuple[float, str, float]: ensemble defect, structure, and energy
     """
-    spl1 = lines[1].split()
-    spl2 = lines[-2].split()
-    try:
-        ensemble_diversity = float(spl2[-1])
-    except ValueError:
-        ensemble_diversity = 0.0
-    mfe = float(spl1[-1].strip("()"))
-    structure = spl1[0]
-    return ensemble_diversity, structure, mfe
+    mfe_match = _MFE_RE.search(output)
+    if mfe_match is None:
+        raise ViennaException(f"Could not parse RNAfold output: {output!r}")
+    div_match = _DIV_RE.search(output, mfe_match.end())
+    ensemble_diversity = float(div_match.group(1)) if div_match else 0.0
+    structure = mfe_match.group(1).decode("ascii")
+    return ensemble_diversity, structure, float(mfe_match.group(2))
 
 
-# public functions #############################################################
-def fold(seq: str, bp_probs: bool = False) -> FoldResults:
+def _run_in_tmp_dir(
+    args: Sequence[str], stdin_bytes: bytes, files: Optional[Dict[str, bytes]] = None
+) -> bytes:
     """
-    Fold an RNA sequence using RNAfold.
+    Run a program in a new private directory, so the PostScript and other
+    files it writes never land in the working directory or collide with
+    other calls. The directory is removed afterwards.
+
+    Args:
+        args (Sequence[str]): command line of the program
+        stdin_bytes (bytes): input for the program
+        files (Optional[Dict[str, bytes]]): names of files the program
+            writes, each is replaced by the contents of that file
+
+    Returns:
+        bytes: stdout of the program
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = subprocess.run(
+            args,
+            input=stdin_bytes,
+            stdout=subprocess.PIPE,
+            check=True,
+            cwd=tmp_dir,
+        ).stdout
+        for name in files or {}:
+            with open(os.path.join(tmp_dir, name), "rb") as fhandler:
+                files[name] = fhandler.read()
+    return output
+
+
+def _inverse_fold_with_rna_lib(
+    secstruct: str, constraint: str, n_sol: int
+) -> Tuple[List[str], List[float]]:
+    """
+    Generate sequences in process with RNA.inverse_fold. Like RNAinverse -Fm
+    each run starts from the constraint with every N replaced by a random
+    nucleotide, lowercase nucleotides are kept fixed.
+
+    Args:
+        secstruct (str): Secondary structure in dot bracket notation
+        constraint (str): Sequence constraints
+        n_sol (int): Number of solutions to return
+
+    Returns:
+        Tuple[List[str], List[float]]: sequences and their distance to the
+        target structure
+    """
+    constraint = constraint.ljust(len(secstruct), "N")
+    seqs = []
+    scores = []
+    for _ in range(n_sol):
+        # RNA.inverse_fold writes into the start string, so build a new one
+        start = "".join(random.choice("ACGU") if nt == "N" else nt for nt in constraint)
+        seq, dist = RNA.inverse_fold(start, secstruct)
+        seqs.append(seq)
+        scores.append(float(dist))
+    return seqs, scores
+
+
+def _get_inverse_args(n_sol: int) -> List[str]:
+    """
+    Get the RNAinverse command line.
+
+    Args:
+        n_sol (int): Number of solutions to generate per structure
+
+    Returns:
+        List[str]: RNAinverse arguments
+    """
+    return ["RNAinverse", "-Fmp", "-f", "0.5", "-d2", f"-R{n_sol}"]
+
+
+def _run_inverse_once(
+    secstruct: str, constraint: str, n_sol: int
+) -> Tuple[List[str], List[float]]:
+    """
+    Run a new RNAinverse process for one structure and constraint.
+
+    Args:
+        secstruct (str): Secondary structure in dot bracket notation
+        constraint (str): Sequence constraints
+        n_sol (int): Number of solutions to return
+
+    Returns:
+        Tuple[List[str], List[float]]: sequences and their scores
+    """
+    output = _run_in_tmp_dir(
+        _get_inverse_args(n_sol), f"{secstruct}\n{constraint}\n".encode()
+    )
+    # one sweep over the output skips the progress lines in C
+    matches = _INV_RE.findall(output)
+    seqs = [seq.decode("ascii") for seq, _ in matches]
+    scores = [float(score) for _, score in matches]
+    return seqs, scores
+
+
+def _run_inverse_batch(
+    pairs: List[Tuple[str, str]], n_sol: int
+) -> List[Tuple[List[str], List[float]]]:
+    """
+    Run one RNAinverse process for several structures and constraints.
+    RNAinverse reads one structure and constraint pair after the other and
+    writes n_sol solutions for each of them in order.
+
+    Args:
+        pairs (List[Tuple[str, str]]): Secondary structures and their
+            sequence constraints
+        n_sol (int): Number of solutions to return per structure
+
+    Returns:
+        List[Tuple[List[str], List[float]]]: sequences and their scores for
+        each pair in the same order
+    """
+    output = _run_in_tmp_dir(
+        _get_inverse_args(n_sol),
+        "".join(f"{ss}\n{c}\n" for ss, c in pairs).encode(),
+    )
+    matches = _INV_RE.findall(output)
+    if len(matches) != len(pairs) * n_sol:
+        raise ViennaException(f"Could not parse RNAinverse output: {output!r}")
+    results = []
+    for pos in range(0, len(matches), n_sol):
+        block = matches[pos : pos + n_sol]
+        seqs = [seq.decode("ascii") for seq, _ in block]
+        scores = [float(score) for _, score in block]
+        results.append((seqs, scores))
+    return results
+
+
+def _run_inverse_reused(
+    secstruct: str, constraint: str, n_sol: int, timeout: float
+) -> Tuple[List[str], List[float]]:
+    """
+    Run one structure and constraint through the shared RNAinverse process,
+    starting it if needed. Falls back to a new process if the shared one
+    fails or stops writing.
+
+    Args:
+        secstruct (str): Secondary structure in dot bracket notation
+        constraint (str): Sequence constraints
+        n_sol (int): Number of solutions to return
+        timeout (float): Seconds the shared process may go without writing
+            before falling back
+
+    Returns:
+        Tuple[List[str], List[float]]: sequences and their scores
+    """
+    global _inverse_worker  # pylint: disable=global-statement
+    with _inverse_lock:
+        try:
+            if _inverse_worker is not None and _inverse_worker.n_sol != n_sol:
+                _close_inverse_worker()
+            if _inverse_worker is None:
+                _inverse_worker = _InverseWorker(n_sol, timeout)
+            _inverse_worker.timeout = timeout
+            return _inverse_worker.run(secstruct, constraint)
+        # TimeoutError is an OSError
+        except (OSError, EOFError, ValueError):
+            _close_inverse_worker()
+    return _run_inverse_once(secstruct, constraint, n_sol)
+
+
+def _close_inverse_worker() -> None:
+    """
+    Stop the shared RNAinverse process if it is running.
+    """
+    global _inverse_worker  # pylint: disable=global-statement
+    if _inverse_worker is not None:
+        _inverse_worker.close(kill=True)
+        _inverse_worker = None
+
+
+def _no_bp_probs() -> np.ndarray:
+    """
+    Get an empty base pair probability array.
+
+    Returns:
+        np.ndarray: empty array with BP_PROBS_DTYPE
+    """
+    return np.empty(0, dtype=BP_PROBS_DTYPE)
+
+
+def _sum_pair_probs(
+    i_s: np.ndarray, j_s: np.ndarray, p_s: np.ndarray, n_nts: int
+) -> np.ndarray:
+    """
+    Get the probability that each nucleotide is paired from the pairs it is
+    in.
+
+    Args:
+        i_s (np.ndarray): 1-indexed first nucleotide of each pair
+        j_s (np.ndarray): 1-indexed second nucleotide of each pair
+        p_s (np.ndarray): probability of each pair
+        n_nts (int): number of nucleotides
+
+    Returns:
+        np.ndarray: float64 array with one entry per nucleotide
+    """
+    p_s = np.asarray(p_s, dtype=np.float64)
+    paired = np.bincount(i_s, weights=p_s, minlength=n_nts + 1)
+    paired += np.bincount(j_s, weights=p_s, minlength=n_nts + 1)
+    # rounding can push a sum just over 1, bincount gives int64 without pairs
+    return np.minimum(paired[1:], 1.0).astype(np.float64)
+
+
+def _get_dot_ps_bp_probs(dot_ps: bytes, n_nts: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the base pair probabilities from a dot plot written by RNAfold.
+
+    Args:
+        dot_ps (bytes): contents of the dot.ps file
+        n_nts (int): number of nucleotides in the folded sequence
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: i, j and probability of each pair in
+        the dot plot, and the probability that each nucleotide is paired
+    """
+    bp_probs = np.fromregex(
+        io.BytesIO(dot_ps),
+        _UBOX_RE,
+        [("i", np.int32), ("j", np.int32), ("p", np.float64)],
+    )
+    # dot.ps stores the square root of the pair probability
+    bp_probs["p"] **= 2
+    paired = _sum_pair_probs(bp_probs["i"], bp_probs["j"], bp_probs["p"], n_nts)
+    return bp_probs.astype(BP_PROBS_DTYPE), paired
+
+
+def _get_model_details() -> "RNA.md":
+    """
+    Get the model details matching the RNAfold options used by this module
+    (--noLP -d2). Built once per process and shared read only by every fold,
+    do not modify it. RNA.md copies RNA.cvar when it is built, so later
+    changes to RNA.cvar in other code do not change it.
+
+    Returns:
+        RNA.md: model details for RNA.fold_compound
+    """
+    global _MD  # pylint: disable=global-statement
+    if _MD is None:
+        md = RNA.md()
+        md.noLP = 1
+        md.dangles = 2
+        _MD = md
+    return _MD
+
+
+def _get_bp_probs(bpp) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the base pair probabilities from a bpp matrix, keeping the same
+    pairs as the dot.ps written by RNAfold.
+
+    Args:
+        bpp: 1-indexed base pair probability matrix from fold_compound.bpp()
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: i, j and probability of each possible
+        pair, and the probability that each nucleotide is paired
+    """
+    probs = np.asarray(bpp, dtype=np.float64)
+    i_s, j_s = np.triu_indices(probs.shape[0], k=1)
+    p_s = probs[i_s, j_s]
+    # the cutoff is well inside the float16 range, no kept pair rounds to 0
+    mask = p_s >= _BP_PROBS_CUTOFF
+    bp_probs = np.empty(np.count_nonzero(mask), dtype=BP_PROBS_DTYPE)
+    bp_probs["i"] = i_s[mask]
+    bp_probs["j"] = j_s[mask]
+    bp_probs["p"] = p_s[mask]
+    paired = _sum_pair_probs(i_s[mask], j_s[mask], p_s[mask], probs.shape[0] - 1)
+    return bp_probs, paired
+
+
+def _encode(seq: str) -> np.ndarray:
+    """
+    Get a sequence or structure as an array of ASCII codes for byte level
+    scans.
+
+    Args:
+        seq (str): RNA sequence or dot bracket structure
+
+    Returns:
+        np.ndarray: uint8 array with one entry per character
+    """
+    return np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+
+
+def _insert_strand_breaks(seq: str, structure: str) -> str:
+    """
+    Add the '&' strand breaks of a sequence to its structure, the python
+    bindings return the structure without them.
+
+    Args:
+        seq (str): Sequences separated by a '&'
+        structure (str): Structure without strand breaks
+
+    Returns:
+        str: Structure with a '&' between each strand
+    """
+    is_nt = _encode(seq) != ord("&")
+    full = np.full(len(seq), ord("&"), dtype=np.uint8)
+    full[is_nt] = _encode(structure)
+    return full.tobytes().decode("ascii")
+
+
+def _fold_with_rna_lib(seq: str, bp_probs: bool, compute_ensemble: bool) -> FoldResults:
+    """
+    Fold an RNA sequence in process with the ViennaRNA python bindings.
+
+    Args:
+        seq (str): The RNA sequence to fold, strands separated by a '&'.
+        bp_probs (bool): Generate base pair probabilities?
+        compute_ensemble (bool): Compute the ensemble diversity?
+
+    Returns:
+        FoldResults: Results from RNA.fold_compound
+    """
+    fc = RNA.fold_compound(seq, _get_model_details())
+    structure, energy = fc.mfe()
+    ens_defect = 0.0
+    if bp_probs or compute_ensemble:
+        fc.exp_params_rescale(energy)
+        fc.pf()
+        if compute_ensemble:
+            ens_defect = round(fc.mean_bp_distance(), 2)
+    bp_probs_arr = _no_bp_probs()
+    paired = None
+    if bp_probs:
+        bp_probs_arr, paired = _get_bp_probs(fc.bpp())
+    if "&" in seq:
+        structure = _insert_strand_breaks(seq, structure)
+    return FoldResults(structure, round(energy, 2), ens_defect, bp_probs_arr, paired)
+
+
+def _detect_tools() -> None:
+    """
+    Look up which programs are in the path, done once at import so folding
+    does not search the path.
+    """
+    globs.rna_fold_exists = shutil.which("RNAfold") is not None
+    globs.rna_cofold_exists = shutil.which("RNAcofold") is not None
+    globs.rna_inverse_exists = shutil.which("RNAinverse") is not None
+    globs.linear_fold_exists = shutil.which("linearfold") is not None
+
+
+def _fold_with_linear_fold(seq: str) -> FoldResults:
+    """
+    Fold an RNA sequence in linear time with LinearFold using the ViennaRNA
+    energy model. LinearFold has no partition function, so there is no
+    ensemble diversity or base pair probabilities.
 
     Args:
         seq (str): The RNA sequence to fold.
-        bp_probs (bool): Generate base pair probabilities? (default: False)
+
+    Returns:
+        FoldResults: Results from LinearFold
+    """
+    if not globs.linear_fold_exists:
+        raise ViennaException("linearfold is not in the path!")
+
+    output = _run_in_tmp_dir(("linearfold", "-V"), f"{seq}\n".encode())
+    _, structure, energy = _get_fold_results(output)
+    return FoldResults(structure, energy, 0.0, _no_bp_probs())
+
+
+def _fold_seq(
+    seq: str, bp_probs: bool, compute_ensemble: bool, algorithm: str
+) -> FoldResults:
+    """
+    Fold an RNA sequence with the requested algorithm.
+
+    Args:
+        seq (str): The uppercase RNA sequence to fold.
+        bp_probs (bool): Generate base pair probabilities?
+        compute_ensemble (bool): Compute the ensemble diversity?
+        algorithm (str): "vienna" or "linear"
 
     Returns:
         FoldResults: Results from RNAfold
     """
+    if algorithm == "linear":
+        return _fold_with_linear_fold(seq)
+
+    if RNA is not None:
+        return _fold_with_rna_lib(seq, bp_probs, compute_ensemble)
+
     if not globs.rna_fold_exists:
-        if shutil.which("RNAfold") is None:
-            raise ViennaException("RNAfold is not in the path!")
-        globs.rna_fold_exists = True
+        raise ViennaException("RNAfold is not in the path!")
 
-    if globs.version == "":
-        output = subprocess.check_output("RNAfold --version", shell=True)
-        spl = output.decode("utf-8").split()
-        globs.version = spl[1]
+    if bp_probs:
+        args = _RNAFOLD_BP_ARGS
+    elif compute_ensemble:
+        args = _RNAFOLD_PF_ARGS
+    else:
+        args = _RNAFOLD_ARGS
 
-    if len(seq) == 0:
-        raise ValueError("Must supply a sequence longer than 0")
+    files = {"dot.ps": b""} if bp_probs else None
+    output = _run_in_tmp_dir(args, f"{seq}\n".encode(), files)
+    ens_defect, structure, energy = _get_fold_results(output)
+    bp_probs_arr = _no_bp_probs()
+    paired = None
+    if bp_probs:
+        bp_probs_arr, paired = _get_dot_ps_bp_probs(files["dot.ps"], len(seq))
+    if not compute_ensemble:
+        ens_defect = 0.0
 
-    ver_spl = globs.version.split(".")
-    cmd = (
-        f'echo "{seq}" | RNAfold -p --noLP --noPS -d2'
-        if bp_probs or int(ver_spl[1]) < 5
-        else f'echo "{seq}" | RNAfold -p --noLP --noDP --noPS -d2'
-    )
+    return FoldResults(structure, energy, ens_defect, bp_probs_arr, paired)
+
+
+@lru_cache(maxsize=131072)
+def _fold_cached(seq: str, compute_ensemble: bool, algorithm: str) -> FoldResults:
+    """
+    Fold an RNA sequence without base pair probabilities, caching the
+    results of repeated sequences.
+
+    Args:
+        seq (str): The uppercase RNA sequence to fold.
+        compute_ensemble (bool): Compute the ensemble diversity?
+        algorithm (str): "vienna" or "linear"
+
+    Returns:
+        FoldResults: Results from RNAfold
+    """
+    return _fold_seq(seq, False, compute_ensemble, algorithm)
 
-    output = subprocess.check_output(cmd, shell=True)
-    lines = output.decode("utf-8").split("\n")
-    ens_defect, structure, energy = _get_fold_results(lines)
-    bp_probs_list = []
 
+def _fold_batch_with_rnafold(seqs: List[str]) -> List[FoldResults]:
+    """
+    Fold several RNA sequences with one RNAfold process. RNAfold reads one
+    sequence per line and writes an MFE and an ensemble diversity line for
+    each of them in order.
+
+    Args:
+        seqs (List[str]): The RNA sequences to fold.
+
+    Returns:
+        List[FoldResults]: Results for each sequence in the same order
+    """
+    if not globs.rna_fold_exists:
+        raise ViennaException("RNAfold is not in the path!")
+
+    output = _run_in_tmp_dir(_RNAFOLD_PF_ARGS, ("\n".join(seqs) + "\n").encode())
+    mfes = _MFE_RE.findall(output)
+    diversities = _DIV_RE.findall(output)
+    if len(mfes) != len(seqs) or len(diversities) != len(seqs):
+        raise ViennaException(f"Could not parse RNAfold output: {output!r}")
+    return [
+        FoldResults(
+            structure.decode("ascii"), float(energy), float(div), _no_bp_probs()
+        )
+        for (structure, energy), div in zip(mfes, diversities)
+    ]
+
+
+def _validate_seqs(seqs: List[str]) -> None:
+    """
+    Check that every sequence can be folded.
+
+    Args:
+        seqs (List[str]): RNA sequences
+
+    Raises:
+        ValueError: if any of the sequences is empty
+    """
+    for seq in seqs:
+        if len(seq) == 0:
+            raise ValueError("Must supply a sequence longer than 0")
+
+
+def _fold_unchecked(
+    seq: str,
+    bp_probs: bool = False,
+    compute_ensemble: bool = True,
+    algorithm: str = "auto",
+) -> FoldResults:
+    """
+    Fold an RNA sequence that has already been validated, see fold for the
+    arguments.
+
+    Returns:
+        FoldResults: Results from RNAfold
+    """
+    if algorithm == "auto":
+        # LinearFold has no partition function, only use it when neither
+        # the ensemble diversity nor bp_probs are wanted
+        use_linear = (
+            not bp_probs
+            and not compute_ensemble
+            and len(seq) > _LINEAR_FOLD_MIN_LENGTH
+            and globs.linear_fold_exists
+        )
+        algorithm = "linear" if use_linear else "vienna"
+    # base pair probabilities are too large to keep for every sequence
     if bp_probs:
-        with open("dot.ps", "r", encoding="UTF-8") as fhandler:
-            lines = fhandler.readlines()
-        for line in lines:
-            spl = line.split()
-            if len(spl) != 4:
-                continue
-            if spl[3] != "ubox":
-                continue
-            bp_probs_list.append([int(spl[0]), int(spl[1]), float(spl[2])])
-        try:
-            os.remove("dot.ps")
-        except FileNotFoundError:
-            pass
+        return _fold_seq(seq.upper(), bp_probs, compute_ensemble, algorithm)
+    return _fold_cached(seq.upper(), compute_ensemble, algorithm)
+
+
+# public functions #############################################################
+def fold(
+    seq: str,
+    bp_probs: bool = False,
+    compute_ensemble: bool = True,
+    algorithm: str = "auto",
+) -> FoldResults:
+    """
+    Fold an RNA sequence using RNAfold.
+
+    Args:
+        seq (str): The RNA sequence to fold.
+        bp_probs (bool): Generate base pair probabilities? (default: False)
+        compute_ensemble (bool): Compute the ensemble diversity with the
+            partition function? If False ens_defect is 0.0 (default: True)
+        algorithm (str): "vienna" for ViennaRNA, "linear" for the linear
+            time approximation of LinearFold, which has no ensemble diversity
+            or base pair probabilities, or "auto" to use LinearFold for
+            sequences over 500 nt when it is installed and neither
+            compute_ensemble nor bp_probs are set (default: "auto")
 
-    return FoldResults(structure, energy, ens_defect, bp_probs_list)
+    Returns:
+        FoldResults: Results from RNAfold
+    """
+    _validate_seqs([seq])
+    if algorithm not in ("auto", "vienna", "linear"):
+        raise ValueError(f"Unknown folding algorithm: {algorithm}")
+    if algorithm == "linear" and bp_probs:
+        raise ValueError("bp_probs are not available with LinearFold")
+    return _fold_unchecked(seq, bp_probs, compute_ensemble, algorithm)
 
 
-def cofold(seq: str) -> FoldResults:
+def fold_many(
+    seqs: List[str], bp_probs: bool = False, workers: Optional[int] = None
+) -> List[FoldResults]:
+    """
+    Fold many RNA sequences in parallel. Each sequence gets its own fold
+    compound (or RNAfold process) so they can be folded independently, all
+    fold compounds in a worker share its read only model details.
+
+    With the RNA python module each call starts a new pool of worker
+    processes. Under the spawn start method (the default on macOS and
+    Windows) the workers import the calling script, so a script calling
+    fold_many must do so under an if __name__ == "__main__": guard.
+
+    Args:
+        seqs (List[str]): The RNA sequences to fold.
+        bp_probs (bool): Generate base pair probabilities? (default: False)
+        workers (Optional[int]): Number of workers, None or 0 for the
+            number of cpus (default: None)
+
+    Returns:
+        List[FoldResults]: Results for each sequence in the same order
+    """
+    _validate_seqs(seqs)
+    if len(seqs) == 0:
+        return []
+    n_workers = workers or os.cpu_count() or 1
+    if RNA is None and not bp_probs:
+        # RNAfold reads many sequences per call, run one batch per worker
+        n_batches = min(len(seqs), n_workers)
+        size = -(-len(seqs) // n_batches)
+        batches = [seqs[pos : pos + size] for pos in range(0, len(seqs), size)]
+        with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+            results = pool.map(_fold_batch_with_rnafold, batches)
+            return [r for batch in results for r in batch]
+    if n_workers == 1 or len(seqs) < 2:
+        return [_fold_unchecked(seq, bp_probs) for seq in seqs]
+    # the SWIG bindings hold the GIL while folding, so they need processes;
+    # RNAfold subprocesses run outside of python and only need threads
+    if RNA is None:
+        pool = ThreadPoolExecutor(max_workers=n_workers)
+    else:
+        pool = ProcessPoolExecutor(
+            max_workers=n_workers, initializer=_get_model_details
+        )
+    # send several sequences per task to cut inter process overhead
+    chunksize = max(1, len(seqs) // (n_workers * 4))
+    with pool:
+        return list(
+            pool.map(_fold_unchecked, seqs, [bp_probs] * len(seqs), chunksize=chunksize)
+        )
+
+
+def cofold(
+    seq: str, compute_ensemble: bool = True, pf_length_limit: Optional[int] = 400
+) -> FoldResults:
     """
     Cofold two RNA sequences to get their combined secondary structure and energy.
 
     Args:
         seq (str): Sequences to fold separated by a '&'
+        compute_ensemble (bool): Compute the ensemble diversity with the
+            partition function? If False ens_defect is 0.0. Only used with
+            the RNA python module, RNAcofold does not report the ensemble
+            diversity so without it ens_defect is always 0.0 (default: True)
+        pf_length_limit (Optional[int]): Skip the partition function for
+            sequences with more nucleotides than this, None for no limit
+            (default: 400)
 
     Returns:
         FoldResults: Results from RNAcofold
     """
-    if not globs.rna_cofold_exists:
-        if shutil.which("RNAcofold") is None:
-            raise ViennaException("RNAcofold is not in the path!")
-        globs.rna_cofold_exists = True
-
     if len(seq) == 0:
         raise ValueError("Must supply a sequence longer than 0")
 
-    output = subprocess.check_output(
-        f'echo "{seq}" | RNAcofold -p --noLP --noPS -d2', shell=True
-    )
-    lines = output.decode("utf-8").split("\n")
-    ens_defect, structure, energy = _get_fold_results(lines)
-    return FoldResults(structure, energy, ens_defect, [])
+    if pf_length_limit is not None and len(seq) - seq.count("&") > pf_length_limit:
+        compute_ensemble = False
+
+    if RNA is not None:
+        return _fold_with_rna_lib(seq, False, compute_ensemble)
+
+    if not globs.rna_cofold_exists:
+        raise ViennaException("RNAcofold is not in the path!")
+
+    # RNAcofold -p prints no ensemble diversity, so skip its partition function
+    output = _run_in_tmp_dir(_RNACOFOLD_ARGS, f"{seq}\n".encode())
+    _, structure, energy = _get_fold_results(output)
+    return FoldResults(structure, energy, 0.0, _no_bp_probs())
 
 
-def inverse_fold(secstruct: str, constraint: str, n_sol: int = 100) -> InverseResults:
+def inverse_fold(
+    secstruct: str,
+    constraint: str,
+    n_sol: int = 100,
+    reuse_process: bool = False,
+    timeout: float = _WORKER_TIMEOUT,
+) -> InverseResults:
     """
     Generates sequences that match a secondary structure with sequence constraint.
 
@@ -185,38 +1059,62 @@ def inverse_fold(secstruct: str, constraint: str, n_sol: int = 100) -> InverseRe
         secstruct (str): Secondary structure in dot bracket notation
         constraint (str): Sequence constraints
         n_sol (int): Number of solutions to return (default: 100)
+        reuse_process (bool): Keep one RNAinverse process running and feed
+            it every call instead of starting a new one, only used without
+            the RNA python module (default: False)
+        timeout (float): Seconds the reused RNAinverse process may go
+            without writing before it is stopped and a new process is used
+            for the call (default: 300)
 
     Returns:
         InverseResults: Results from RNAinverse
     """
+    if RNA is not None:
+        seqs, scores = _inverse_fold_with_rna_lib(secstruct, constraint, n_sol)
+        return InverseResults(seqs, scores)
+
     if not globs.rna_inverse_exists:
-        if shutil.which("RNAinverse") is None:
-            raise ViennaException("RNAinverse is not in the path!")
-        globs.rna_inverse_exists = True
+        raise ViennaException("RNAinverse is not in the path!")
 
-    with open("inverse.in", "w", encoding="utf-8") as fhandler:
-        fhandler.write(f"{secstruct}\n{constraint}\n")
+    if reuse_process:
+        seqs, scores = _run_inverse_reused(secstruct, constraint, n_sol, timeout)
+    else:
+        seqs, scores = _run_inverse_once(secstruct, constraint, n_sol)
+    return InverseResults(seqs, scores)
 
-    output = subprocess.check_output(
-        f"RNAinverse -Fmp -f 0.5 -d2 -R{n_sol} < inverse.in", shell=True
-    )
-    lines = output.decode("utf-8").split("\n")
-    seqs = []
-    scores = []
-    for line in lines:
-        spl = line.split()
-        if len(spl) != 2:
-            continue
-        seqs.append(spl[0])
-        scores.append(float(spl[1]))
-
-    try:
-        os.remove("inverse.in")
-        os.remove("dot.ps")
-    except FileNotFoundError:
-        pass  # ignore
 
-    return InverseResults(seqs, scores)
+def inverse_fold_many(
+    pairs: List[Tuple[str, str]], n_sol: int = 100
+) -> List[InverseResults]:
+    """
+    Generates sequences for several secondary structures with sequence
+    constraints, using one RNAinverse process for all of them.
+
+    Args:
+        pairs (List[Tuple[str, str]]): Secondary structures in dot bracket
+            notation and their sequence constraints
+        n_sol (int): Number of solutions to return per structure
+            (default: 100)
+
+    Returns:
+        List[InverseResults]: Results for each pair in the same order
+    """
+    if len(pairs) == 0:
+        return []
+
+    if RNA is not None:
+        return [
+            InverseResults(*_inverse_fold_with_rna_lib(secstruct, constraint, n_sol))
+            for secstruct, constraint in pairs
+        ]
+
+    if not globs.rna_inverse_exists:
+        raise ViennaException("RNAinverse is not in the path!")
+
+    return [
+        InverseResults(seqs, scores)
+        for seqs, scores in _run_inverse_batch(pairs, n_sol)
+    ]
 
 
 def folded_structure(seq: str) -> str:
@@ -226,7 +1124,8 @@ def folded_structure(seq: str) -> str:
     Args:
         seq (str): RNA sequence
     """
-    fold_result = fold(seq)
+    # stay on ViennaRNA, LinearFold only approximates the MFE structure
+    fold_result = fold(seq, compute_ensemble=False, algorithm="vienna")
     return fold_result.dot_bracket
 
 
@@ -241,4 +1140,24 @@ def does_sequence_fold_to(seq: str, target_structure: str) -> bool:
     Returns:
         bool: True if the sequence folds into the target structure, False otherwise
     """
-    return folded_structure(seq, target_structure)
+    return folded_structure(seq) == target_structure
+
+
+def clear_cache() -> None:
+    """
+    Discard the cached fold results, for example to free memory after
+    folding many different sequences.
+    """
+    _fold_cached.cache_clear()
+
+
+def reset_model_details() -> None:
+    """
+    Discard the cached model details so they are rebuilt on the next fold.
+    """
+    global _MD  # pylint: disable=global-statement
+    _MD = None
+
+
+_detect_tools()
+atexit.register(_close_inverse_worker)